@@ -8,9 +8,24 @@ class Settings(BaseSettings):
     
     # Database
     DATABASE_URL: str
+    DB_POOL_MIN: int = 5
+    DB_POOL_MAX: int = 20  # WEB_CONCURRENCY x DB_POOL_MAX + WORKER_DB_POOL_MAX <= Postgres max_connections
+    DB_STATEMENT_CACHE_SIZE: int = 1024
     
     # Redis
     REDIS_URL: Optional[str] = None
+    REDIS_MAX_CONNECTIONS: int = 64
+    REDIS_KEEPIDLE_SECONDS: int = 60
+    REDIS_HEALTH_CHECK_INTERVAL: int = 30
+    
+    # Worker
+    WORKER_BATCH_SIZE: int = 5  # max jobs per pop; never more than the free slots
+    WORKER_CONCURRENCY: int = 5
+    WORKER_DB_POOL_MIN: int = 2
+    WORKER_DB_POOL_MAX: int = 6  # WORKER_CONCURRENCY + manifest flusher
+    MANIFEST_FLUSH_INTERVAL_MS: int = 100
+    MANIFEST_FLUSH_MAX_ROWS: int = 500
+    PIPELINE_SIMULATE_WORK: bool = False  # sleep through placeholder pipeline phases
     
     # API Keys (for AI services)
     OPENAI_API_KEY: Optional[str] = None
@@ -25,8 +40,21 @@ class Settings(BaseSettings):
     FINOPS_HARD_LIMIT_PRO: int = 60
     FINOPS_HARD_LIMIT_ENTERPRISE: int = 150
     
+    # Onboarding profile rules (strictly greater than)
+    ONBOARDING_ENTERPRISE_REVENUE: int = 50000
+    ONBOARDING_PRO_AD_BUDGET: int = 5000
+    ONBOARDING_ENTERPRISE_COUNTRIES: int = 3
+    ONBOARDING_PRO_PRODUCT_COUNT: int = 5
+    
     class Config:
         env_file = ".env"
         case_sensitive = True
 
 settings = Settings()
+
+# Profile details (monthly price in EUR)
+PROFILES = {
+    "starter": {"price": 79, "features": {"videos": False, "mlops": False}},
+    "pro": {"price": 249, "features": {"videos": True, "mlops": False}},
+    "enterprise": {"price": 990, "features": {"videos": True, "mlops": True}}
+}
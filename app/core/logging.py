@@ -0,0 +1,17 @@
+import logging
+
+import orjson
+import structlog
+
+def configure_logging(level: int = logging.INFO):
+    """Configure structlog with cached, level-filtered loggers and orjson rendering"""
+    structlog.configure(
+        cache_logger_on_first_use=True,
+        wrapper_class=structlog.make_filtering_bound_logger(level),
+        logger_factory=structlog.BytesLoggerFactory(),
+        processors=[
+            structlog.processors.add_log_level,
+            structlog.processors.TimeStamper(fmt="iso", utc=True),
+            structlog.processors.JSONRenderer(serializer=orjson.dumps),
+        ],
+    )
@@ -0,0 +1,20 @@
+import socket
+
+import redis.asyncio as redis
+
+from app.core.config import settings
+
+def create_redis_pool(url: str) -> redis.BlockingConnectionPool:
+    """Bounded Redis connection pool with TCP keepalive and periodic health checks"""
+    # TCP_KEEPIDLE is Linux-only (missing on macOS)
+    keepalive_options = {}
+    if hasattr(socket, "TCP_KEEPIDLE"):
+        keepalive_options[socket.TCP_KEEPIDLE] = settings.REDIS_KEEPIDLE_SECONDS
+    
+    return redis.BlockingConnectionPool.from_url(
+        url,
+        max_connections=settings.REDIS_MAX_CONNECTIONS,
+        socket_keepalive=True,
+        socket_keepalive_options=keepalive_options,
+        health_check_interval=settings.REDIS_HEALTH_CHECK_INTERVAL
+    )
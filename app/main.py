@@ -1,18 +1,74 @@
-from fastapi import FastAPI, HTTPException, Depends
+from fastapi import FastAPI, HTTPException, Depends, Request
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
+from fastapi.responses import ORJSONResponse
+from pydantic import BaseModel, ConfigDict, Field
+import asyncio
+from contextlib import asynccontextmanager
 import structlog
+import json
+import orjson
 import os
-from typing import Optional
+import uuid
+from typing import Annotated, Any, Optional
 import asyncpg
 import redis.asyncio as redis
 
+from app.core.config import PROFILES, settings
+from app.core.logging import configure_logging
+from app.core.redis import create_redis_pool
+
+configure_logging()
 logger = structlog.get_logger()
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Open Postgres and Redis connections for the app's lifetime"""
+    # Connect to Postgres
+    DATABASE_URL = os.getenv("DATABASE_URL")
+    if not DATABASE_URL:
+        raise RuntimeError("DATABASE_URL not set")
+    
+    db_pool = await asyncpg.create_pool(
+        DATABASE_URL,
+        min_size=settings.DB_POOL_MIN,
+        max_size=settings.DB_POOL_MAX,
+        statement_cache_size=settings.DB_STATEMENT_CACHE_SIZE,
+        command_timeout=60
+    )
+    redis_pool: Optional[redis.BlockingConnectionPool] = None
+    redis_client: Optional[redis.Redis] = None
+    
+    try:
+        # Warm up the pool before serving traffic
+        await db_pool.fetchval("SELECT 1")
+        logger.info("postgres_connected", pool_size=settings.DB_POOL_MAX)
+        
+        # Connect to Redis
+        REDIS_URL = os.getenv("REDIS_URL")
+        if REDIS_URL:
+            redis_pool = create_redis_pool(REDIS_URL)
+            redis_client = redis.Redis(connection_pool=redis_pool)
+            logger.info("redis_connected")
+        else:
+            logger.warning("redis_not_configured")
+        
+        app.state.db_pool = db_pool
+        app.state.redis_client = redis_client
+        
+        yield
+    finally:
+        await db_pool.close()
+        if redis_client:
+            await redis_client.close()
+        if redis_pool:
+            await redis_pool.disconnect()
+
 app = FastAPI(
     title="AEGIS v2 API",
     version="2.0.0",
-    description="Production-ready API for AEGIS multi-tenant pipeline"
+    description="Production-ready API for AEGIS multi-tenant pipeline",
+    default_response_class=ORJSONResponse,
+    lifespan=lifespan
 )
 
 # CORS - Allow Vercel frontend
@@ -28,64 +84,34 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Global state
-db_pool: Optional[asyncpg.Pool] = None
-redis_client: Optional[redis.Redis] = None
-
-@app.on_event("startup")
-async def startup():
-    global db_pool, redis_client
-    
-    # Connect to Postgres
-    DATABASE_URL = os.getenv("DATABASE_URL")
-    if not DATABASE_URL:
-        raise RuntimeError("DATABASE_URL not set")
-    
-    db_pool = await asyncpg.create_pool(
-        DATABASE_URL,
-        min_size=2,
-        max_size=10,
-        command_timeout=60
-    )
-    logger.info("postgres_connected", pool_size=10)
-    
-    # Connect to Redis
-    REDIS_URL = os.getenv("REDIS_URL")
-    if REDIS_URL:
-        redis_client = await redis.from_url(REDIS_URL, decode_responses=True)
-        logger.info("redis_connected")
-    else:
-        logger.warning("redis_not_configured")
-
-@app.on_event("shutdown")
-async def shutdown():
-    global db_pool, redis_client
-    if db_pool:
-        await db_pool.close()
-    if redis_client:
-        await redis_client.close()
-
 @app.get("/health")
-async def health():
+async def health(request: Request):
     """Health check endpoint for Render"""
+    db_pool = request.app.state.db_pool
+    redis_client = request.app.state.redis_client
     checks = {"api": "ok"}
     
-    # Check Postgres
-    if db_pool:
+    async def check_postgres():
         try:
-            async with db_pool.acquire() as conn:
-                await conn.fetchval("SELECT 1")
-            checks["postgres"] = "ok"
+            await db_pool.fetchval("SELECT 1")
+            return "ok"
         except Exception as e:
-            checks["postgres"] = f"error: {str(e)}"
+            return f"error: {str(e)}"
     
-    # Check Redis
-    if redis_client:
+    async def check_redis():
         try:
             await redis_client.ping()
-            checks["redis"] = "ok"
+            return "ok"
         except Exception as e:
-            checks["redis"] = f"error: {str(e)}"
+            return f"error: {str(e)}"
+    
+    # Probe Postgres and Redis concurrently
+    probes = {}
+    if db_pool:
+        probes["postgres"] = check_postgres()
+    if redis_client:
+        probes["redis"] = check_redis()
+    checks.update(zip(probes, await asyncio.gather(*probes.values())))
     
     all_ok = all(v == "ok" for v in checks.values())
     status_code = 200 if all_ok else 503
@@ -94,59 +120,62 @@ async def health():
 
 # Models
 class OnboardingRequest(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+    
     tenant_id: str
-    revenue_monthly: int
-    ad_budget_monthly: int
-    target_countries: list[str]
-    product_count: int
+    revenue_monthly: Annotated[int, Field(ge=0)]
+    ad_budget_monthly: Annotated[int, Field(ge=0)]
+    target_countries: list[str] = Field(max_length=50)
+    product_count: Annotated[int, Field(ge=0)]
 
 class ProfileResponse(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+    
     profile: str
     monthly_price_eur: int
     features: dict
     reason: str
 
+def format_threshold(value: int) -> str:
+    """Render a rule threshold as in the reason strings (50000 -> "50k")"""
+    if value >= 1000 and value % 1000 == 0:
+        return f"{value // 1000}k"
+    return str(value)
+
 @app.post("/api/v2/onboarding", response_model=ProfileResponse)
-async def onboarding(req: OnboardingRequest):
+async def onboarding(req: OnboardingRequest, request: Request):
     """Profile selection based on AEGIS config rules"""
+    db_pool = request.app.state.db_pool
     logger.info("onboarding_start", tenant_id=req.tenant_id)
     
     # Rule-based selection (from config)
-    if req.revenue_monthly > 50000:
+    if req.revenue_monthly > settings.ONBOARDING_ENTERPRISE_REVENUE:
         profile = "enterprise"
-        reason = "revenue > 50k"
-    elif req.ad_budget_monthly > 5000:
+        reason = f"revenue > {format_threshold(settings.ONBOARDING_ENTERPRISE_REVENUE)}"
+    elif req.ad_budget_monthly > settings.ONBOARDING_PRO_AD_BUDGET:
         profile = "pro"
-        reason = "ad_budget > 5k"
-    elif len(req.target_countries) > 3:
+        reason = f"ad_budget > {format_threshold(settings.ONBOARDING_PRO_AD_BUDGET)}"
+    elif len(req.target_countries) > settings.ONBOARDING_ENTERPRISE_COUNTRIES:
         profile = "enterprise"
         reason = "multi-country"
-    elif req.product_count > 5:
+    elif req.product_count > settings.ONBOARDING_PRO_PRODUCT_COUNT:
         profile = "pro"
-        reason = "product_count > 5"
+        reason = f"product_count > {format_threshold(settings.ONBOARDING_PRO_PRODUCT_COUNT)}"
     else:
         profile = "starter"
         reason = "default"
     
-    # Profile details
-    profiles = {
-        "starter": {"price": 79, "features": {"videos": False, "mlops": False}},
-        "pro": {"price": 249, "features": {"videos": True, "mlops": False}},
-        "enterprise": {"price": 990, "features": {"videos": True, "mlops": True}}
-    }
-    
-    selected = profiles[profile]
+    selected = PROFILES[profile]
     
     # Store in DB
-    async with db_pool.acquire() as conn:
-        await conn.execute(
-            """
-            INSERT INTO aegis.tenants (tenant_id, profile, revenue_monthly, ad_budget_monthly, created_at)
-            VALUES ($1, $2, $3, $4, NOW())
-            ON CONFLICT (tenant_id) DO UPDATE SET profile = $2, updated_at = NOW()
-            """,
-            req.tenant_id, profile, req.revenue_monthly, req.ad_budget_monthly
-        )
+    await db_pool.execute(
+        """
+        INSERT INTO aegis.tenants (tenant_id, profile, revenue_monthly, ad_budget_monthly, created_at)
+        VALUES ($1, $2, $3, $4, NOW())
+        ON CONFLICT (tenant_id) DO UPDATE SET profile = $2, updated_at = NOW()
+        """,
+        req.tenant_id, profile, req.revenue_monthly, req.ad_budget_monthly
+    )
     
     logger.info("onboarding_complete", tenant_id=req.tenant_id, profile=profile)
     
@@ -157,85 +186,105 @@ async def onboarding(req: OnboardingRequest):
         reason=reason
     )
 
+def encode_job(job: dict) -> bytes:
+    """Serialize a queue payload, falling back to stdlib json where orjson would fail or lose data"""
+    try:
+        payload = orjson.dumps(job)
+    except orjson.JSONEncodeError:
+        # Integers beyond 64 bits
+        return json.dumps(job).encode()
+    if b"null" in payload:
+        # orjson writes NaN/Infinity as null; stdlib json keeps them
+        return json.dumps(job).encode()
+    return payload
+
 class PipelineRequest(BaseModel):
+    model_config = ConfigDict(extra="ignore")
+    
     tenant_id: str
     store_id: str
-    product_data: dict
+    product_data: dict[str, Any]
 
 @app.post("/api/v2/pipeline/run")
-async def run_pipeline(req: PipelineRequest):
+async def run_pipeline(req: PipelineRequest, request: Request):
     """Enqueue pipeline run (processed by worker)"""
+    db_pool = request.app.state.db_pool
+    redis_client = request.app.state.redis_client
     logger.info("pipeline_enqueue", tenant_id=req.tenant_id, store_id=req.store_id)
     
     # Generate run_id
-    import uuid
     run_id = str(uuid.uuid4())
     
+    # Serialize before the INSERT so a bad payload can't leave an orphaned 'queued' row
+    job_json = encode_job({
+        "run_id": run_id,
+        "tenant_id": req.tenant_id,
+        "store_id": req.store_id,
+        "product_data": req.product_data
+    })
+    
     # Store in manifest_v2_index
-    async with db_pool.acquire() as conn:
-        await conn.execute(
-            """
-            INSERT INTO aegis.manifest_v2_index 
-            (tenant_id, store_id, run_id, status, created_at)
-            VALUES ($1, $2, $3, 'queued', NOW())
-            """,
-            req.tenant_id, req.store_id, run_id
-        )
+    await db_pool.execute(
+        """
+        INSERT INTO aegis.manifest_v2_index 
+        (tenant_id, store_id, run_id, status, created_at)
+        VALUES ($1, $2, $3, 'queued', NOW())
+        """,
+        req.tenant_id, req.store_id, run_id
+    )
     
     # Enqueue to Redis
     if redis_client:
-        import json
-        await redis_client.lpush(
-            "aegis:pipeline:queue",
-            json.dumps({
-                "run_id": run_id,
-                "tenant_id": req.tenant_id,
-                "store_id": req.store_id,
-                "product_data": req.product_data
-            })
-        )
+        await redis_client.lpush("aegis:pipeline:queue", job_json)
     
     logger.info("pipeline_queued", run_id=run_id)
     
     return {"run_id": run_id, "status": "queued"}
 
 @app.get("/api/v2/manifest/{tenant_id}/{store_id}")
-async def get_manifest(tenant_id: str, store_id: str):
+async def get_manifest(tenant_id: str, store_id: str, request: Request):
     """Get latest manifest for store"""
-    async with db_pool.acquire() as conn:
-        # Get latest run
-        row = await conn.fetchrow(
-            """
+    db_pool = request.app.state.db_pool
+    # Latest run and its modules in a single round trip
+    row = await db_pool.fetchrow(
+        """
+        SELECT i.run_id, i.status, i.deploy_ready, i.created_at,
+               COALESCE(m.modules, '{}'::jsonb) AS modules
+        FROM (
             SELECT run_id, status, deploy_ready, created_at
             FROM aegis.manifest_v2_index
             WHERE tenant_id = $1 AND store_id = $2
             ORDER BY created_at DESC
             LIMIT 1
-            """,
-            tenant_id, store_id
-        )
-        
-        if not row:
-            raise HTTPException(404, "No manifest found")
-        
-        # Get modules
-        modules = await conn.fetch(
-            """
-            SELECT module_name, module_data
+        ) i
+        LEFT JOIN LATERAL (
+            SELECT jsonb_object_agg(module_name, module_data::text) AS modules
             FROM aegis.manifest_v2_modules
-            WHERE run_id = $1
-            """,
-            row["run_id"]
-        )
-        
-        return {
-            "run_id": row["run_id"],
-            "status": row["status"],
-            "deploy_ready": row["deploy_ready"],
-            "created_at": row["created_at"].isoformat(),
-            "modules": {m["module_name"]: m["module_data"] for m in modules}
-        }
+            WHERE run_id = i.run_id
+        ) m ON TRUE
+        """,
+        tenant_id, store_id
+    )
+    
+    if not row:
+        raise HTTPException(404, "No manifest found")
+    
+    return {
+        "run_id": row["run_id"],
+        "status": row["status"],
+        "deploy_ready": row["deploy_ready"],
+        "created_at": row["created_at"].isoformat(),
+        "modules": orjson.loads(row["modules"])
+    }
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    # Keep workers x DB_POOL_MAX + WORKER_DB_POOL_MAX <= Postgres max_connections
+    uvicorn.run(
+        "app.main:app",
+        host="0.0.0.0",
+        port=8000,
+        workers=int(os.getenv("WEB_CONCURRENCY", 1)),
+        loop="uvloop",
+        http="httptools"
+    )
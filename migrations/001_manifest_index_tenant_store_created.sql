@@ -0,0 +1,4 @@
+-- Latest-run lookup for GET /api/v2/manifest/{tenant_id}/{store_id}
+-- CONCURRENTLY cannot run inside a transaction block: apply with plain psql
+CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_manifest_tenant_store_created
+    ON aegis.manifest_v2_index (tenant_id, store_id, created_at DESC);
@@ -1,26 +1,172 @@
 import asyncio
 import json
 import os
+import re
+import signal
+import sys
 import structlog
+import orjson
 import asyncpg
 import redis.asyncio as redis
+import uvloop
 from typing import Optional
 
+from app.core.config import settings
+from app.core.logging import configure_logging
+from app.core.redis import create_redis_pool
+
+configure_logging()
 logger = structlog.get_logger()
 
+PIPELINE_QUEUE = "aegis:pipeline:queue"
+# Digit runs too long to be sure they fit orjson's 64-bit integers
+LONG_NUMBER = re.compile(rb"\d{20}")
+
 db_pool: Optional[asyncpg.Pool] = None
+redis_pool: Optional[redis.BlockingConnectionPool] = None
 redis_client: Optional[redis.Redis] = None
+use_blmpop = False  # Redis >= 7 supports BLMPOP batch pops
+# Jobs currently being processed, at most WORKER_CONCURRENCY
+running_jobs: set = set()
+flusher: Optional[asyncio.Task] = None
+# (run_id, deploy_ready, module records, completion future) awaiting flush
+manifest_queue: asyncio.Queue = asyncio.Queue()
+
+MODULE_COLUMNS = ["run_id", "module_name", "module_data"]
+
+# Audit module payload is identical for every run
+AUDIT_BLOB = orjson.dumps({"checks_passed": 12, "checks_failed": 0}).decode()
+
+COMPLETE_RUN_SQL = """
+    UPDATE aegis.manifest_v2_index 
+    SET status = 'completed', deploy_ready = $2, updated_at = NOW()
+    WHERE run_id = $1
+"""
+
+class WorkerConnection(asyncpg.Connection):
+    """Connection holding the worker's per-job prepared statements"""
+    complete_run: asyncpg.prepared_stmt.PreparedStatement
+
+async def init_connection(conn: WorkerConnection):
+    """Prepare recurring statements once per pooled connection"""
+    conn.complete_run = await conn.prepare(COMPLETE_RUN_SQL)
 
 async def init_connections():
-    global db_pool, redis_client
+    global db_pool, redis_pool, redis_client, use_blmpop
     
     DATABASE_URL = os.getenv("DATABASE_URL")
-    db_pool = await asyncpg.create_pool(DATABASE_URL, min_size=2, max_size=5)
+    db_pool = await asyncpg.create_pool(
+        DATABASE_URL,
+        min_size=settings.WORKER_DB_POOL_MIN,
+        max_size=settings.WORKER_DB_POOL_MAX,
+        statement_cache_size=settings.DB_STATEMENT_CACHE_SIZE,
+        connection_class=WorkerConnection,
+        init=init_connection
+    )
     logger.info("worker_postgres_connected")
     
     REDIS_URL = os.getenv("REDIS_URL")
-    redis_client = await redis.from_url(REDIS_URL, decode_responses=True)
-    logger.info("worker_redis_connected")
+    redis_pool = create_redis_pool(REDIS_URL)
+    redis_client = redis.Redis(connection_pool=redis_pool)
+    
+    try:
+        server = await redis_client.info("server")
+        use_blmpop = int(str(server["redis_version"]).split(".")[0]) >= 7
+    except Exception as e:
+        logger.warning("redis_version_check_failed", error=str(e))
+    logger.info("worker_redis_connected", blmpop=use_blmpop)
+
+async def write_manifest(run_id: str, deploy_ready: bool, modules: list):
+    """Queue a run's modules for the next flush and wait until they are committed"""
+    if flusher is None or flusher.done():
+        raise RuntimeError("manifest flusher not running")
+    done = asyncio.get_running_loop().create_future()
+    records = [(run_id, module_name, module_data) for module_name, module_data in modules]
+    await manifest_queue.put((run_id, deploy_ready, records, done))
+    await done
+
+async def flush_manifests(batch: list):
+    """Write queued modules with COPY and mark their runs completed in one transaction"""
+    async with db_pool.acquire() as conn:
+        async with conn.transaction():
+            await conn.copy_records_to_table(
+                "manifest_v2_modules",
+                schema_name="aegis",
+                columns=MODULE_COLUMNS,
+                records=[record for _, _, records, _ in batch for record in records]
+            )
+            await conn.complete_run.executemany(
+                [(run_id, deploy_ready) for run_id, deploy_ready, _, _ in batch]
+            )
+
+async def flush_loop():
+    """Coalesce manifest writes from concurrent jobs, flushing every MANIFEST_FLUSH_INTERVAL_MS"""
+    loop = asyncio.get_running_loop()
+    
+    while True:
+        batch = [await manifest_queue.get()]
+        rows = len(batch[0][2])
+        deadline = loop.time() + settings.MANIFEST_FLUSH_INTERVAL_MS / 1000
+        
+        while rows < settings.MANIFEST_FLUSH_MAX_ROWS:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                item = await asyncio.wait_for(manifest_queue.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+            batch.append(item)
+            rows += len(item[2])
+        
+        failures = {}
+        try:
+            try:
+                await flush_manifests(batch)
+            except Exception as e:
+                # Retry runs one by one so a single bad run doesn't fail the batch
+                logger.warning("manifest_flush_batch_failed", runs=len(batch), error=str(e))
+                for item in batch:
+                    try:
+                        await flush_manifests([item])
+                    except Exception as run_error:
+                        logger.error("manifest_flush_failed", run_id=item[0], error=str(run_error))
+                        failures[item[0]] = run_error
+            
+            for run_id, _, _, done in batch:
+                if done.done():
+                    continue
+                if run_id in failures:
+                    done.set_exception(failures[run_id])
+                else:
+                    done.set_result(None)
+            logger.info("manifest_flushed", runs=len(batch) - len(failures), rows=rows)
+        finally:
+            for *_, done in batch:
+                # Only reached if the flusher itself is dying; don't leave jobs waiting
+                if not done.done():
+                    done.set_exception(RuntimeError("manifest flush interrupted"))
+                manifest_queue.task_done()
+
+def flusher_stopped(task: asyncio.Task, main_task: asyncio.Task):
+    """Fail waiting writes and stop the worker if the manifest flusher exits"""
+    if task.cancelled():
+        return
+    error = task.exception() or RuntimeError("manifest flusher exited")
+    logger.error("manifest_flusher_stopped", error=str(error))
+    
+    # Nothing will flush these anymore
+    while not manifest_queue.empty():
+        *_, done = manifest_queue.get_nowait()
+        if not done.done():
+            done.set_exception(error)
+        manifest_queue.task_done()
+    main_task.cancel()
+
+async def simulate_work(seconds: float):
+    """Placeholder for phase work, skipped unless PIPELINE_SIMULATE_WORK is set"""
+    if settings.PIPELINE_SIMULATE_WORK:
+        await asyncio.sleep(seconds)
 
 async def process_pipeline_job(job_data: dict):
     """Process a single pipeline job"""
@@ -28,112 +174,160 @@ async def process_pipeline_job(job_data: dict):
     tenant_id = job_data["tenant_id"]
     store_id = job_data["store_id"]
     
-    logger.info("pipeline_start", run_id=run_id, tenant_id=tenant_id, store_id=store_id)
+    log = logger.bind(run_id=run_id, tenant_id=tenant_id)
+    log.info("pipeline_start", store_id=store_id)
     
     try:
-        # Update status to processing
-        async with db_pool.acquire() as conn:
-            await conn.execute(
-                "UPDATE aegis.manifest_v2_index SET status = 'processing', updated_at = NOW() WHERE run_id = $1",
-                run_id
-            )
+        # Update status to processing, confirming the run exists
+        claimed = await db_pool.fetchval(
+            "UPDATE aegis.manifest_v2_index SET status = 'processing', updated_at = NOW() WHERE run_id = $1 RETURNING TRUE",
+            run_id
+        )
+        if not claimed:
+            log.warning("pipeline_run_not_found")
+            return
         
         # PHASE 1: Prefetch (simulated)
-        logger.info("phase_1_prefetch", run_id=run_id)
-        await asyncio.sleep(2)  # Simulate work
+        log.info("phase_1_prefetch")
+        await simulate_work(2)
         
         # PHASE 2: Hard Block Validations
-        logger.info("phase_2_hard_block", run_id=run_id)
-        await asyncio.sleep(3)
+        log.info("phase_2_hard_block")
+        await simulate_work(3)
         
         # Check hard gates (simplified)
         deploy_ready = True  # In real: check TEXT_SIMILARITY, AI_LIKENESS, etc.
         reasons = []
         
         # PHASE 3: Assets Generation
-        logger.info("phase_3_assets", run_id=run_id)
-        await asyncio.sleep(5)
+        log.info("phase_3_assets")
+        await simulate_work(5)
         
         # PHASE 4: Soft Checks (non-blocking)
-        logger.info("phase_4_soft_checks", run_id=run_id)
-        await asyncio.sleep(2)
+        log.info("phase_4_soft_checks")
+        await simulate_work(2)
         
         # PHASE 5: Manifest Build
-        logger.info("phase_5_manifest", run_id=run_id)
+        log.info("phase_5_manifest")
         
-        # Store modules in manifest_v2_modules
-        async with db_pool.acquire() as conn:
-            # Audit module
-            await conn.execute(
-                """
-                INSERT INTO aegis.manifest_v2_modules (run_id, module_name, module_data)
-                VALUES ($1, 'audit', $2)
-                """,
-                run_id,
-                json.dumps({"checks_passed": 12, "checks_failed": 0})
-            )
-            
-            # Decision module
-            await conn.execute(
-                """
-                INSERT INTO aegis.manifest_v2_modules (run_id, module_name, module_data)
-                VALUES ($1, 'decision', $2)
-                """,
-                run_id,
-                json.dumps({"deploy_ready": deploy_ready, "reasons": reasons})
-            )
-            
-            # Deployment module
-            await conn.execute(
-                """
-                INSERT INTO aegis.manifest_v2_modules (run_id, module_name, module_data)
-                VALUES ($1, 'deployment', $2)
-                """,
-                run_id,
-                json.dumps({"ready_to_deploy_path": f"s3://aegis/{tenant_id}/{store_id}/{run_id}"})
-            )
-            
-            # Update index
-            await conn.execute(
-                """
-                UPDATE aegis.manifest_v2_index 
-                SET status = 'completed', deploy_ready = $2, updated_at = NOW()
-                WHERE run_id = $1
-                """,
-                run_id, deploy_ready
-            )
+        # Store modules and update index via the batched manifest writer
+        await write_manifest(run_id, deploy_ready, [
+            ("audit", AUDIT_BLOB),
+            ("decision", orjson.dumps({"deploy_ready": deploy_ready, "reasons": reasons}).decode()),
+            ("deployment", orjson.dumps({"ready_to_deploy_path": f"s3://aegis/{tenant_id}/{store_id}/{run_id}"}).decode()),
+        ])
         
-        logger.info("pipeline_complete", run_id=run_id, deploy_ready=deploy_ready)
+        log.info("pipeline_complete", deploy_ready=deploy_ready)
         
     except Exception as e:
-        logger.error("pipeline_failed", run_id=run_id, error=str(e))
-        async with db_pool.acquire() as conn:
-            await conn.execute(
-                "UPDATE aegis.manifest_v2_index SET status = 'failed', updated_at = NOW() WHERE run_id = $1",
-                run_id
-            )
+        log.error("pipeline_failed", error=str(e))
+        await db_pool.execute(
+            "UPDATE aegis.manifest_v2_index SET status = 'failed', updated_at = NOW() WHERE run_id = $1",
+            run_id
+        )
+
+async def fetch_jobs(count: int) -> list:
+    """Pop up to count jobs, blocking for up to 5s when the queue is empty"""
+    if use_blmpop:
+        # Single atomic batch pop; replies [key, [jobs...]] or None on timeout
+        result = await redis_client.execute_command(
+            "BLMPOP", 5, 1, PIPELINE_QUEUE, "RIGHT", "COUNT", count
+        )
+        if result:
+            _, jobs = result
+            return jobs
+        return []
+    
+    pipe = redis_client.pipeline(transaction=False)
+    for _ in range(count):
+        pipe.rpop(PIPELINE_QUEUE)
+    jobs = [job_json for job_json in await pipe.execute() if job_json is not None]
+    if jobs:
+        return jobs
+    
+    # Queue empty - BRPOP with 5s timeout
+    result = await redis_client.brpop(PIPELINE_QUEUE, timeout=5)
+    if result:
+        _, job_json = result
+        return [job_json]
+    return []
+
+def decode_job(job_json: bytes) -> dict:
+    """Parse a queue payload, using stdlib json where orjson would fail or lose data"""
+    if LONG_NUMBER.search(job_json):
+        # orjson turns integers beyond 64 bits into floats
+        return json.loads(job_json)
+    try:
+        return orjson.loads(job_json)
+    except orjson.JSONDecodeError:
+        # NaN/Infinity, which the API enqueues via stdlib json
+        return json.loads(job_json)
+
+async def run_job(job_json: bytes):
+    """Decode and process a job"""
+    try:
+        job_data = decode_job(job_json)
+    except ValueError as e:
+        logger.error("job_decode_failed", error=str(e))
+        return
+    await process_pipeline_job(job_data)
+
+def job_finished(task: asyncio.Task):
+    """Free the job's slot and log any exception it raised"""
+    running_jobs.discard(task)
+    if not task.cancelled() and task.exception():
+        logger.error("job_error", error=str(task.exception()))
 
 async def worker_loop():
     """Main worker loop - polls Redis queue"""
-    logger.info("worker_started")
+    logger.info("worker_started", batch_size=settings.WORKER_BATCH_SIZE, concurrency=settings.WORKER_CONCURRENCY)
     
     while True:
         try:
-            # BRPOP with 5s timeout
-            result = await redis_client.brpop("aegis:pipeline:queue", timeout=5)
+            free = settings.WORKER_CONCURRENCY - len(running_jobs)
+            if free <= 0:
+                # All slots busy - wait for one to free up before popping more
+                await asyncio.wait(running_jobs, return_when=asyncio.FIRST_COMPLETED)
+                continue
             
-            if result:
-                _, job_json = result
-                job_data = json.loads(job_json)
-                await process_pipeline_job(job_data)
+            for job_json in await fetch_jobs(min(free, settings.WORKER_BATCH_SIZE)):
+                task = asyncio.create_task(run_job(job_json))
+                running_jobs.add(task)
+                task.add_done_callback(job_finished)
             
         except Exception as e:
             logger.error("worker_error", error=str(e))
             await asyncio.sleep(5)
 
 async def main():
+    global flusher
+    
     await init_connections()
-    await worker_loop()
+    main_task = asyncio.current_task()
+    flusher = asyncio.create_task(flush_loop())
+    flusher.add_done_callback(lambda task: flusher_stopped(task, main_task))
+    
+    # Render stops services with SIGTERM; route it through the drain below
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, main_task.cancel)
+    
+    try:
+        await worker_loop()
+    except asyncio.CancelledError:
+        logger.info("worker_stopping")
+    finally:
+        # Let in-flight jobs finish, then drain pending manifest writes before closing connections
+        if running_jobs:
+            await asyncio.gather(*running_jobs, return_exceptions=True)
+        await manifest_queue.join()
+        flusher_failed = flusher.done()
+        flusher.cancel()
+        await db_pool.close()
+        await redis_client.close()
+        await redis_pool.disconnect()
+    
+    if flusher_failed:
+        # Exit non-zero so Render restarts the worker
+        sys.exit(1)
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    uvloop.run(main())